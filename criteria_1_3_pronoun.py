@@ -1,69 +1,140 @@
-from pythainlp import word_tokenize
-from pythainlp.tag import pos_tag
+from functools import lru_cache
+from importlib.util import find_spec
+
+import ahocorasick
+from pythainlp.tokenize import Tokenizer, word_tokenize
 
 FAMILY_TERMS = ["ลุง", "ป้า", "น้า", "อา"]
 PHI_TERM = "พี่"  # Never allowed
 MONK_TERMS = ["ท่าน", "พระคุณเจ้า"]
 MONK_SELF_TERMS = ["หลวงพี่", "หลวงพ่อ", "อาตมา"]
 ALL_TERMS = FAMILY_TERMS + MONK_TERMS + MONK_SELF_TERMS
+_MONK_SELF_SET = frozenset(MONK_SELF_TERMS)
 
 # Common prefixes that might appear before terms
 PREFIXES = ["คุณ"]
 
-def is_self_reference(term, utterance):
-    """Check if term is used as self-reference with more robust detection"""
-    # Special case for monk terms
-    if term in MONK_SELF_TERMS and term in utterance:
-        return True
-        
-    # Tokenize
-    tokens = word_tokenize(utterance, engine="newmm")
-    if term not in tokens:
-        return False
-        
-    # Check for negation
-    if f"ไม่ใช่{term}" in utterance:
-        return False
-        
-    # Don't rely only on POS tagging - if the term is in tokens, consider it
-    return True
+# Prefixed variants and match vocabulary, built once at import
+_PREFIXED = {(prefix, term): f"{prefix}{term}"
+             for prefix in PREFIXES for term in ALL_TERMS + [PHI_TERM]}
+_MATCH_TERMS = ALL_TERMS + [PHI_TERM] + list(_PREFIXED.values())
 
-def find_terms_in_text(text):
-    """Find terms in text, including with prefixes"""
-    found_terms = set()
+# First characters of every match term; text without any of them has no terms
+_TRIGGER_CHARS = frozenset(term[0] for term in _MATCH_TERMS)
+
+# One bit per match term, so term groups are int bitmasks and checks are bitops
+_TERM_BIT = {term: 1 << i for i, term in enumerate(_MATCH_TERMS)}
+
+def _mask_of(terms):
+    """Return the bitmask of the given match terms"""
+    mask = 0
+    for term in terms:
+        mask |= _TERM_BIT[term]
+    return mask
+
+def _terms_of(mask):
+    """Return the match terms set in mask (only needed for reporting)"""
+    return [term for term, bit in _TERM_BIT.items() if mask & bit]
+
+def _with_prefixes(term):
+    """Return term together with all its prefixed variants"""
+    return {term} | {_PREFIXED[(prefix, term)] for prefix in PREFIXES}
+
+_PHI_MASK = _mask_of(_with_prefixes(PHI_TERM))
+
+# "ท่าน" and prefixed versions are always allowed
+_ALWAYS_ALLOWED_MASK = _mask_of(_with_prefixes("ท่าน"))
+
+def _allowed_after(term):
+    """Return the mask of terms the agent may use once the caller self-references with term"""
+    allowed = _with_prefixes(term)
+    # For monk self-terms, also allow MONK_TERMS
+    if term in _MONK_SELF_SET:
+        for monk_term in MONK_TERMS:
+            allowed |= _with_prefixes(monk_term)
+    return _mask_of(allowed)
+
+_ALLOWED_AFTER = {term: _allowed_after(term) for term in ALL_TERMS}
+
+def _build_term_automaton():
+    """Build an Aho-Corasick automaton over every term and prefixed variant"""
+    automaton = ahocorasick.Automaton()
+    for term, bit in _TERM_BIT.items():
+        automaton.add_word(term, (term, bit))
+    automaton.make_automaton()
+    return automaton
+
+_TERM_AUTOMATON = _build_term_automaton()
+
+# Prefer nlpO3, the Rust port of newmm (pip install nlpo3), when it is installed
+_USE_NLPO3 = find_spec("nlpo3") is not None
+
+# Otherwise share one newmm tokenizer so its dictionary trie is built once, not per call
+_TOK = None if _USE_NLPO3 else Tokenizer(engine="newmm")
+
+def _word_tokenize(text):
+    """Tokenize text with nlpO3 if available, otherwise the shared newmm tokenizer"""
+    if _USE_NLPO3:
+        return word_tokenize(text, engine="nlpo3")
+    return _TOK.word_tokenize(text)
+
+@lru_cache(maxsize=4096)
+def _tok(text):
+    """Cached tokenization - short utterances like "ค่ะ" or greetings repeat a lot"""
+    return tuple(_word_tokenize(text))
+
+def self_references(text):
+    """Return the terms the caller uses to refer to themself in text"""
+    # Substring check first - most lines contain no term and need no tokenizing
+    candidates = [term for term in ALL_TERMS if term in text]
+    if not candidates:
+        return set()
     
-    # Tokenize and tag
-    tokens = word_tokenize(text, engine="newmm")
-    pos_tags = pos_tag(tokens)
+    # Monk self-terms count wherever they appear in the text
+    refs = {term for term in candidates if term in _MONK_SELF_SET}
     
-    # Check for direct matches using token list and POS tagging
-    for term in ALL_TERMS + [PHI_TERM]:
-        # Method 1: Check in tokens regardless of POS
-        if term in tokens:
-            found_terms.add(term)
-            continue
-            
-        # Method 2: Check with POS tagging as backup
-        for word, tag in pos_tags:
-            if word == term and tag == 'NCMN':
-                found_terms.add(term)
-                break
+    # Other terms must not be negated ("ไม่ใช่ป้า") and must be whole tokens
+    others = [term for term in candidates
+              if term not in refs and f"ไม่ใช่{term}" not in text]
+    if others:
+        tokens = _tok(text)
+        refs.update(term for term in others if term in tokens)
     
-    # Check for prefixed versions using tokens
-    for prefix in PREFIXES:
-        for term in ALL_TERMS + [PHI_TERM]:
-            prefixed_term = f"{prefix}{term}"
-            # Check if the prefixed term is in the text as a token
-            if prefixed_term in tokens or any(word == prefixed_term for word, _ in pos_tags):
-                found_terms.add(prefixed_term)
+    return refs
+
+def _find_terms_mask(text):
+    """Return the bitmask of terms used in text"""
+    # Cheap reject before scanning, e.g. for all-ASCII lines
+    if _TRIGGER_CHARS.isdisjoint(text):
+        return 0
     
-    return found_terms
+    mask = 0
+    tokens = None
+    # One pass over the raw text for every term and prefixed variant
+    for _, (term, bit) in _TERM_AUTOMATON.iter(text):
+        if mask & bit:
+            continue
+        # Substring hits (e.g. "อา" inside "อาการ") only count as whole tokens
+        if tokens is None:
+            tokens = _tok(text)
+        if term in tokens:
+            mask |= bit
+    return mask
+
+def find_terms_in_text(text):
+    """Find terms in text, including with prefixes"""
+    return set(_terms_of(_find_terms_mask(text)))
+
+def format_violation(violation):
+    """Render a (line, kind, terms) violation as a readable message"""
+    line_no, kind, terms = violation
+    return f"Line {line_no}: Used {kind} term(s): {list(terms)}"
 
 def evaluate_conversation(file_path):
-    """Evaluate conversation file for pronoun usage"""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        lines = [line.strip() for line in f if line.strip()]
+    """Evaluate conversation file for pronoun usage
     
+    Violations are stored as (line, kind, terms) tuples; use format_violation() to render them.
+    """
     results = {
         'status': 'PASS',
         'self_referenced': [],
@@ -71,82 +142,54 @@ def evaluate_conversation(file_path):
         'violations': []
     }
     
-    # Set to track self-referenced terms throughout the conversation
+    # Track self-referenced terms and the mask of terms they allow, updated
+    # only when the caller self-references with a new term
     self_ref_terms = set()
+    allowed_mask = _ALWAYS_ALLOWED_MASK
     
-    for i, line in enumerate(lines):
-        if line.startswith('Speaker 2:'):  # Caller line
-            text = line[10:].strip()
-            
-            # Look for self-references
-            for term in ALL_TERMS:
-                if is_self_reference(term, text):
-                    self_ref_terms.add(term)
-        
-        elif line.startswith('Speaker 1:'):  # Agent line
-            text = line[10:].strip()
-            
-            # Calculate allowed terms at this point in the conversation
-            allowed_terms = set()
+    # Stream the file; i counts non-empty lines for violation messages
+    with open(file_path, 'r', encoding='utf-8', buffering=65536) as f:
+        i = 0
+        for raw in f:
+            line = raw.strip()
+            if not line:
+                continue
+            i += 1
             
-            # "ท่าน" and prefixed versions are always allowed
-            allowed_terms.add("ท่าน")
-            for prefix in PREFIXES:
-                allowed_terms.add(f"{prefix}ท่าน")
-            
-            # Add terms that have been self-referenced up to this point
-            for term in self_ref_terms:
-                allowed_terms.add(term)
-                for prefix in PREFIXES:
-                    allowed_terms.add(f"{prefix}{term}")
+            if line.startswith('Speaker 2:'):  # Caller line
+                text = line[10:].strip()
                 
-                # For monk self-terms, also allow MONK_TERMS
-                if term in MONK_SELF_TERMS:
-                    for monk_term in MONK_TERMS:
-                        allowed_terms.add(monk_term)
-                        for prefix in PREFIXES:
-                            allowed_terms.add(f"{prefix}{monk_term}")
-            
-            # Find terms used in this agent line
-            used_terms = find_terms_in_text(text)
+                # Look for self-references
+                for term in self_references(text):
+                    if term not in self_ref_terms:
+                        self_ref_terms.add(term)
+                        allowed_mask |= _ALLOWED_AFTER[term]
             
-            if used_terms:
-                # Check for PHI_TERM (never allowed)
-                phi_terms = {term for term in used_terms 
-                            if term == PHI_TERM or (term.startswith("คุณ") and term[3:] == PHI_TERM)}
+            elif line.startswith('Speaker 1:'):  # Agent line
+                text = line[10:].strip()
                 
-                if phi_terms:
-                    results['status'] = 'FAIL'
-                    results['violations'].append(f"Line {i+1}: Used forbidden term(s): {list(phi_terms)}")
+                # Find terms used in this agent line
+                used_mask = _find_terms_mask(text)
                 
-                # Check for terms not allowed at this point
-                disallowed_terms = {term for term in used_terms 
-                                  if term not in allowed_terms and term not in phi_terms}
-                
-                if disallowed_terms:
-                    results['status'] = 'FAIL'
-                    results['violations'].append(f"Line {i+1}: Used unapproved term(s): {list(disallowed_terms)}")
+                if used_mask:
+                    # Check for PHI_TERM (never allowed)
+                    phi_mask = used_mask & _PHI_MASK
+                    
+                    if phi_mask:
+                        results['status'] = 'FAIL'
+                        results['violations'].append((i, 'forbidden', tuple(_terms_of(phi_mask))))
+                    
+                    # Check for terms not allowed at this point
+                    disallowed_mask = used_mask & ~allowed_mask & ~_PHI_MASK
+                    
+                    if disallowed_mask:
+                        results['status'] = 'FAIL'
+                        results['violations'].append((i, 'unapproved', tuple(_terms_of(disallowed_mask))))
     
     # Update final results
     results['self_referenced'] = list(self_ref_terms)
     
-    # Calculate final allowed terms for reporting
-    final_allowed_terms = set(["ท่าน"])
-    for prefix in PREFIXES:
-        final_allowed_terms.add(f"{prefix}ท่าน")
-    
-    for term in self_ref_terms:
-        final_allowed_terms.add(term)
-        for prefix in PREFIXES:
-            final_allowed_terms.add(f"{prefix}{term}")
-        
-        if term in MONK_SELF_TERMS:
-            for monk_term in MONK_TERMS:
-                final_allowed_terms.add(monk_term)
-                for prefix in PREFIXES:
-                    final_allowed_terms.add(f"{prefix}{monk_term}")
-        
-    # results['allowed_terms'] = list(final_allowed_terms)
+    # results['allowed_terms'] = _terms_of(allowed_mask)
     
     # print("Final evaluation:")
     # print(f"  Status: {results['status']}")
@@ -1,27 +1,102 @@
+import hashlib
 import os
 import librosa
 import numpy as np
 import pandas as pd
-from joblib import load
+import soundfile as sf
+from joblib import Parallel, delayed, load
 from pathlib import Path
 from tqdm import tqdm
 
 MODEL_PATH = "/home/ckancha/rnd/tone_analysis/final-week/deployment/multitask_acoustic_model.joblib"  
+_MODEL = None  # loaded lazily by load_multitask_model()
+# next to this module, so runs from any working directory share one cache
+FEATURE_CACHE_DIR = Path(__file__).resolve().parent / ".feature_cache"
+# part of every cache key - bump whenever extract_features changes so stale
+# entries are ignored (or clear .feature_cache/ by hand)
+FEATURE_VERSION = 1
+
+def feature_cache_path(file_path):
+    """Cache file for an audio file, keyed by its absolute path, size, mtime and FEATURE_VERSION"""
+    stat = file_path.stat()
+    path_hash = hashlib.sha1(str(file_path.resolve()).encode('utf-8')).hexdigest()
+    return FEATURE_CACHE_DIR / f"{path_hash}_{stat.st_size}_{stat.st_mtime_ns}_v{FEATURE_VERSION}.npz"
+
+def load_cached_features(cache_path):
+    """Return cached features, or None on a miss or an unreadable cache entry"""
+    if not cache_path.exists():
+        return None
+    try:
+        with np.load(cache_path) as cached:
+            return {key: cached[key].item() for key in cached.files}
+    except Exception as e:
+        # e.g. truncated by a killed worker - drop it so it is rebuilt
+        print(f"Discarding unreadable feature cache {cache_path}: {str(e)}")
+        try:
+            cache_path.unlink()
+        except OSError:
+            pass
+        return None
+
+def save_cached_features(cache_path, features):
+    """Write features to the cache atomically; a failure only skips caching"""
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **features)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"Could not write feature cache {cache_path}: {str(e)}")
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
 
 def extract_features(file_path):
     try:
-        y, sr = librosa.load(file_path, sr=None)
+        file_path = Path(file_path)
+        
+        # reuse features extracted on an earlier run if the file is unchanged
+        cache_path = feature_cache_path(file_path)
+        cached = load_cached_features(cache_path)
+        if cached is not None:
+            return cached
+        
+        # soundfile decodes WAV/FLAC directly; librosa handles the rest (MP3)
+        # and any WAV/FLAC codec libsndfile cannot read (via audioread)
+        y = None
+        if file_path.suffix.lower() in ('.wav', '.flac'):
+            try:
+                y, sr = sf.read(str(file_path), dtype='float32', always_2d=False)
+                if y.ndim > 1:
+                    y = y.mean(axis=1)
+            except sf.SoundFileError:
+                y = None
+        if y is None:
+            y, sr = librosa.load(file_path, sr=None)
         
-        features = {'file_id': Path(file_path).stem}
+        # empty audio would give NaN features; skip the file like any other error
+        if len(y) == 0:
+            raise ValueError("empty audio")
+        
+        features = {'file_id': file_path.stem}
+        
+        # STFT once and share the magnitude spectrogram between features
+        stft = librosa.stft(y)
+        S_mag = np.abs(stft)
     
         # willing_to_serve, not_sluggish, not_monotone
-        pitches, magnitudes = librosa.piptrack(y=y, sr=sr)
-        pitches = pitches[pitches > 0]
-        if len(pitches) > 0:
+        pitches, _ = librosa.piptrack(S=S_mag, sr=sr)
+        voiced = pitches > 0
+        n_voiced = np.count_nonzero(voiced)
+        if n_voiced > 0:
+            pitches = pitches[voiced]
+            pitch_mean = pitches.mean()
             features.update({
-                'pitch_mean': np.mean(pitches),
-                'pitch_std': np.std(pitches),
-                'pitch_jitter': np.mean(np.abs(np.diff(pitches))) / np.mean(pitches) if len(pitches) > 1 else 0
+                'pitch_mean': pitch_mean,
+                'pitch_std': pitches.std(),
+                'pitch_jitter': np.abs(np.diff(pitches)).mean() / pitch_mean if n_voiced > 1 else 0
             })
         else:
             features.update({'pitch_mean': 0, 'pitch_std': 0, 'pitch_jitter': 0})
@@ -35,21 +110,25 @@ def extract_features(file_path):
         
         # not_monotone, not_harsh
         spectral = {
-            'spectral_centroid': np.mean(librosa.feature.spectral_centroid(y=y, sr=sr)),
-            'spectral_bandwidth': np.mean(librosa.feature.spectral_bandwidth(y=y, sr=sr)),
-            'spectral_flatness': np.mean(librosa.feature.spectral_flatness(y=y))
+            'spectral_centroid': np.mean(librosa.feature.spectral_centroid(S=S_mag, sr=sr)),
+            'spectral_bandwidth': np.mean(librosa.feature.spectral_bandwidth(S=S_mag, sr=sr)),
+            'spectral_flatness': np.mean(librosa.feature.spectral_flatness(S=S_mag))
         }
         features.update(spectral)
         
         # not_harsh
-        harmonic = librosa.effects.harmonic(y)
+        # same as librosa.effects.harmonic(y), but reusing the STFT above
+        stft_harm, _ = librosa.decompose.hpss(stft)
+        harmonic = librosa.istft(stft_harm, dtype=y.dtype, length=len(y))
+        h_mean = np.mean(harmonic)
         features.update({
-            'harmonicity': np.mean(harmonic),
-            'hnr': 10 if np.mean(harmonic) > 0.9 else (5 if np.mean(harmonic) > 0.5 else 1)
+            'harmonicity': h_mean,
+            'hnr': 10 if h_mean > 0.9 else (5 if h_mean > 0.5 else 1)
         })
         
         # willing_to_serve, not_sluggish features
-        features['speech_rate'] = len(y) / librosa.get_duration(y=y, sr=sr)
+        # samples / duration is just the sample rate; kept since the model expects it
+        features['speech_rate'] = float(sr)
         
         # not_monotone
         features['trailing_slope'] = (energy[0][-1] - energy[0][0]) / len(energy[0]) if len(energy[0]) > 0 else 0
@@ -61,6 +140,10 @@ def extract_features(file_path):
             'mfcc2': np.mean(mfccs[1])
         })
         
+        # only cache rows the model can use, so a bad file is retried next run
+        if all(np.isfinite(value) for key, value in features.items() if key != 'file_id'):
+            save_cached_features(cache_path, features)
+        
         return features
         
     except Exception as e:
@@ -68,10 +151,13 @@ def extract_features(file_path):
         return None
 
 def load_multitask_model():
-    """Load the trained multitask model"""
-    if not os.path.exists(MODEL_PATH):
-        raise FileNotFoundError(f"Model not found at {MODEL_PATH}")
-    return load(MODEL_PATH)
+    """Load the trained multitask model (once per process, arrays memory-mapped)"""
+    global _MODEL
+    if _MODEL is None:
+        if not os.path.exists(MODEL_PATH):
+            raise FileNotFoundError(f"Model not found at {MODEL_PATH}")
+        _MODEL = load(MODEL_PATH, mmap_mode='r')
+    return _MODEL
 
 def predict_with_multitask(model, feature_df, thresholds):
     """Run predictions using the multitask model"""
@@ -83,46 +169,46 @@ def predict_with_multitask(model, feature_df, thresholds):
     if missing:
         raise ValueError(f"Missing required features: {missing}")
     
-    # Predict probabilities for all criteria at once
-    proba = model.predict_proba(feature_df[required_features])
+    # Predict probabilities for all criteria at once, on float32 inputs
+    # (kept as a DataFrame so the feature names still match the fitted model)
+    X = feature_df[required_features].astype(np.float32)
+    proba = model.predict_proba(X)
     
-    # Convert to DataFrame with proper column names
-    predictions = feature_df.copy()
+    # Convert to DataFrame with proper column names (file id + results only)
+    predictions = pd.DataFrame({'file_id': feature_df['file_id'].to_numpy()}, index=feature_df.index)
     for i, criterion in enumerate(thresholds.keys()):
-        predictions[f"{criterion}_probability"] = proba[i][:, 1]
+        probability = proba[i][:, 1]
+        predictions[f"{criterion}_probability"] = probability
         # Add pass/fail column for each criterion
-        predictions[f"{criterion}_pass"] = predictions[f"{criterion}_probability"] >= thresholds[criterion]
+        predictions[f"{criterion}_pass"] = probability >= thresholds[criterion]
     
     return predictions
 
 def calculate_criteria_scores(predictions, thresholds):
     """Calculate detailed criteria scores with pass rate information"""
     total_files = len(predictions)
-    num_criteria_passed = 0
-    criteria_details = {}
     
-    for criterion in thresholds:
-        # Count files that pass this criterion
-        pass_column = f"{criterion}_pass"
-        passed_files = predictions[pass_column].sum()
-        
-        # Calculate pass rate (0.0 to 1.0)
-        pass_rate = passed_files / total_files if total_files > 0 else 0
-        
-        # Score is 1 if pass rate is >= 60%, otherwise 0
-        score = 1 if pass_rate >= 0.60 else 0
-        
-        # Track if this criterion passed the threshold
-        if score == 1:
-            num_criteria_passed += 1
-        
-        # result details - optional
-        criteria_details[criterion] = {
+    # Count files that pass each criterion in one reduction over the pass columns
+    pass_columns = [f"{criterion}_pass" for criterion in thresholds]
+    passed = predictions[pass_columns].to_numpy(dtype=np.bool_).sum(axis=0)
+    
+    # Calculate pass rate (0.0 to 1.0)
+    pass_rates = passed / max(total_files, 1)
+    
+    # Score is 1 if pass rate is >= 60%, otherwise 0
+    scores = (pass_rates >= 0.60).astype(int)
+    num_criteria_passed = int(scores.sum())
+    
+    # result details - optional
+    criteria_details = {
+        criterion: {
             'passed_files': int(passed_files),
             'total_files': total_files,
-            'pass_rate': pass_rate,
-            'score': score
+            'pass_rate': float(pass_rate),
+            'score': int(score)
         }
+        for criterion, passed_files, pass_rate, score in zip(thresholds, passed, pass_rates, scores)
+    }
     
     return num_criteria_passed, criteria_details
 
@@ -155,8 +241,10 @@ def tone_analysis(input_dir, twang_score=0):
         print(f"Error: No valid audio files found in input directory: {input_dir}")
         return 0, len(thresholds), False
     
-    for audio_file in tqdm(audio_files):
-        feat = extract_features(audio_file)
+    # Files are independent, so extract them in parallel worker processes
+    parallel = Parallel(n_jobs=-1, return_as="generator")
+    jobs = (delayed(extract_features)(audio_file) for audio_file in audio_files)
+    for feat in tqdm(parallel(jobs), total=len(audio_files)):
         if feat is not None:
             features.append(feat)
     